@@ -5,7 +5,7 @@ from PyQt6.QtWidgets import (
     QComboBox, QPushButton, QTextEdit, QGroupBox, QFormLayout
 )
 from PyQt6.QtCore import pyqtSignal, QTimer, Qt
-from sms_manager import SMSManager, ProviderType, SMSOrder, RentStatus, SMSException
+from sms_manager import SMSManager, ProviderType, SMSOrder, RentStatus, SMSException, close_shared_connector
 
 class SMSWidget(QWidget):
     """
@@ -18,7 +18,12 @@ class SMSWidget(QWidget):
         super().__init__(parent)
         self.manager = None
         self.current_order = None
-        self.is_monitoring = False
+        self._poll_task = None
+        self.poll_timeout = 300     # Max wait for SMS (seconds)
+        self.poll_interval = 3      # Initial poll interval (seconds)
+        self.max_poll_interval = 15 # Backoff cap (seconds)
+        self._log_buffer = []
+        self._manager_cache = {} # (provider, api_key) -> SMSManager, keeps sessions alive
         self.setup_ui()
 
     def setup_ui(self):
@@ -86,23 +91,34 @@ class SMSWidget(QWidget):
         self.log_area = QTextEdit()
         self.log_area.setReadOnly(True)
         self.log_area.setMaximumHeight(100)
+        self.log_area.document().setMaximumBlockCount(500) # Cap log history
         status_layout.addWidget(self.log_area)
         
         status_group.setLayout(status_layout)
         layout.addWidget(status_group)
 
-        # Timer for polling
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.check_sms_status)
+        # Flush buffered log lines in batches instead of one relayout per line.
+        # Single-shot and only armed by log(), so an idle widget has no timer wakeups.
+        self.log_timer = QTimer(self)
+        self.log_timer.setSingleShot(True)
+        self.log_timer.setInterval(100)
+        self.log_timer.timeout.connect(self.flush_log)
 
     def log(self, msg):
-        self.log_area.append(msg)
+        if not self._log_buffer:
+            self.log_timer.start()
+        self._log_buffer.append(msg)
         self.log_message.emit(msg)
 
+    def flush_log(self):
+        if self._log_buffer:
+            self.log_area.append("\n".join(self._log_buffer))
+            self._log_buffer.clear()
+
     @qasync.asyncSlot()
     async def on_check_balance(self):
         try:
-            self.init_manager()
+            await self.init_manager()
             balance = await self.manager.get_balance()
             self.lbl_balance.setText(f"Balance: {balance}")
             self.log(f"Balance checked: {balance}")
@@ -113,7 +129,7 @@ class SMSWidget(QWidget):
     @qasync.asyncSlot()
     async def on_rent_number(self):
         try:
-            self.init_manager()
+            await self.init_manager()
             country = self.input_country.text().strip()
             service = self.input_service.text().strip()
             
@@ -127,45 +143,45 @@ class SMSWidget(QWidget):
             self.log(f"Number rented: {self.current_order.phone_number} (ID: {self.current_order.order_id})")
             
             self.btn_cancel.setEnabled(True)
-            self.is_monitoring = True
-            self.timer.start(5000) # Poll every 5 seconds
+            self._poll_task = asyncio.create_task(self._poll_loop())
 
         except Exception as e:
             self.log(f"Rent failed: {e}")
             self.btn_rent.setEnabled(True)
 
-    @qasync.asyncSlot()
-    async def check_sms_status(self):
-        if not self.current_order or not self.is_monitoring:
-            self.timer.stop()
-            return
-
+    async def _poll_loop(self):
         try:
-            # Check for SMS
-            self.current_order = await self.manager.check_sms(self.current_order)
-            
-            if self.current_order.status == RentStatus.RECEIVED or self.current_order.sms_code:
+            # wait_for_code logs and retries transient API errors itself
+            self.current_order = await self.manager.wait_for_code(
+                self.current_order,
+                timeout_seconds=self.poll_timeout,
+                check_interval=self.poll_interval,
+                max_interval=self.max_poll_interval
+            )
+        except Exception as e:
+            self.log(f"Error checking SMS: {e}")
+
+        if self.current_order:
+            if self.current_order.is_complete:
                 code = self.current_order.sms_code
                 self.lbl_code.setText(f"Code: {code}")
                 self.log(f"SMS Received! Code: {code}")
                 self.log(f"Full Text: {self.current_order.sms_text}")
-                
                 self.code_received.emit(code)
-                self.is_monitoring = False
-                self.timer.stop()
-                self.btn_rent.setEnabled(True)
-                
             elif self.current_order.status == RentStatus.TIMEOUT:
+                self.lbl_code.setText("Code: Timeout")
                 self.log("Timeout waiting for SMS.")
-                self.is_monitoring = False
-                self.timer.stop()
-                self.btn_rent.setEnabled(True)
-                
-        except Exception as e:
-            self.log(f"Error checking SMS: {e}")
+
+        self.btn_rent.setEnabled(True)
+
+    def stop_polling(self):
+        if self._poll_task and not self._poll_task.done():
+            self._poll_task.cancel()
+        self._poll_task = None
 
     @qasync.asyncSlot()
     async def on_cancel_rent(self):
+        self.stop_polling()
         if self.current_order:
             try:
                 self.log("Cancelling order...")
@@ -174,15 +190,13 @@ class SMSWidget(QWidget):
             except Exception as e:
                 self.log(f"Cancel failed: {e}")
         
-        self.is_monitoring = False
-        self.timer.stop()
         self.btn_rent.setEnabled(True)
         self.btn_cancel.setEnabled(False)
         self.lbl_phone.setText("Phone: -")
         self.lbl_code.setText("Code: -")
         self.current_order = None
 
-    def init_manager(self):
+    async def init_manager(self):
         provider_str = self.combo_provider.currentText()
         api_key = self.input_api_key.text().strip()
         
@@ -195,7 +209,32 @@ class SMSWidget(QWidget):
             "vak-sms": ProviderType.VAK_SMS
         }
         
-        self.manager = SMSManager(mapping[provider_str], api_key)
+        key = (provider_str, api_key)
+        await self._evict_stale_managers(provider_str, api_key)
+        if key not in self._manager_cache:
+            self._manager_cache[key] = SMSManager(mapping[provider_str], api_key)
+        self.manager = self._manager_cache[key]
+
+    async def _evict_stale_managers(self, provider_str, api_key):
+        # Close managers left behind by an edited API key for this provider,
+        # except one still used by an active poll (evicted on a later call)
+        polling = self._poll_task is not None and not self._poll_task.done()
+        for key in list(self._manager_cache):
+            if key[0] != provider_str or key[1] == api_key:
+                continue
+            manager = self._manager_cache[key]
+            if polling and manager is self.manager:
+                continue
+            del self._manager_cache[key]
+            await manager.close()
+
+    async def close_managers(self):
+        self.stop_polling()
+        managers = list(self._manager_cache.values())
+        self._manager_cache.clear()
+        self.manager = None
+        for manager in managers:
+            await manager.close()
 
 # --- Standalone Test Runner ---
 if __name__ == "__main__":
@@ -205,14 +244,23 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
     loop = qasync.QEventLoop(app)
     asyncio.set_event_loop(loop)
-    
-    win = QWidget()
-    win.setWindowTitle("SMS Widget Test")
-    layout = QVBoxLayout(win)
-    sms_widget = SMSWidget()
-    layout.addWidget(sms_widget)
-    
-    win.show()
+
+    async def main():
+        app_close_event = asyncio.Event()
+        app.aboutToQuit.connect(app_close_event.set)
+
+        win = QWidget()
+        win.setWindowTitle("SMS Widget Test")
+        layout = QVBoxLayout(win)
+        sms_widget = SMSWidget()
+        layout.addWidget(sms_widget)
+        
+        win.show()
+
+        # Release HTTP sessions and the shared connector before the loop stops
+        await app_close_event.wait()
+        await sms_widget.close_managers()
+        await close_shared_connector()
     
     with loop:
-        loop.run_forever()
+        loop.run_until_complete(main())
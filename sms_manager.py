@@ -1,22 +1,41 @@
 import asyncio
 import aiohttp
+import atexit
+import hashlib
 import logging
-import json
+import logging.handlers
+import msgspec
+import orjson
+import queue
+import random
+import re
+import sys
+import time
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional, Dict, Any, List
-from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, Dict, Any, List, ClassVar, Tuple, Type
 from datetime import datetime
 
 # --- 配置日志 ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("sms_manager.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# 事件循环中只做入队, 文件/控制台写入由 QueueListener 后台线程完成, 避免阻塞 asyncio
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler("sms_manager.log", encoding='utf-8', delay=True),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue = queue.Queue(-1)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))  # 最终格式由 _log_handlers 负责
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logger = logging.getLogger("SMSManager")
 
 # --- 核心枚举与数据模型 ---
@@ -34,7 +53,8 @@ class RentStatus(Enum):
     CANCELLED = "cancelled" # 已取消
     UNKNOWN = "unknown"
 
-class SMSOrder(BaseModel):
+@dataclass(slots=True)
+class SMSOrder:
     """统一的订单/租用数据模型"""
     order_id: str
     phone_number: str
@@ -44,9 +64,22 @@ class SMSOrder(BaseModel):
     status: RentStatus = RentStatus.WAITING
     sms_text: Optional[str] = None
     sms_code: Optional[str] = None
-    created_at: datetime = Field(default_factory=datetime.now)
+    created_at: datetime = field(default_factory=datetime.now)
     expiration_time: Optional[datetime] = None
 
+    @property
+    def is_complete(self) -> bool:
+        """是否已收到验证码"""
+        return self.sms_code is not None or self.status is RentStatus.RECEIVED
+
+@dataclass(frozen=True)
+class CheckSpec:
+    """各平台 check_sms 响应的字段映射, 由 BaseSMSProvider._apply_check 统一解析"""
+    list_key: Optional[str]     # 短信列表字段; None 表示响应本身就是列表或单条短信
+    code_key: str               # 验证码字段
+    text_key: str               # 短信正文字段
+    finished_value: Optional[Tuple[str, str]] = None  # (字段, 值) 匹配时订单已结束
+
 # --- 自定义异常 ---
 
 class SMSException(Exception):
@@ -65,12 +98,132 @@ class APIRequestError(SMSException):
     """网络或API请求错误"""
     pass
 
+# --- 工具函数 ---
+
+# 短信正文中的 4-8 位数字验证码
+_CODE_RE = re.compile(r'\b(\d{4,8})\b')
+
+def next_poll_interval(interval: float, max_interval: float = 15, factor: float = 1.5) -> float:
+    """指数退避: 下一次轮询间隔按 factor 递增, 不超过 max_interval"""
+    return min(max_interval, interval * factor)
+
+def poll_jitter() -> float:
+    """轮询抖动, 避免多个订单在同一时刻集中请求"""
+    return random.uniform(0, 1)
+
+def parse_iso_datetime(value: Optional[str]) -> Optional[datetime]:
+    """解析 API 返回的 ISO 8601 时间 (兼容结尾的 'Z'), 无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+# 可重试的 HTTP 状态码 (限流 / 网关暂时不可用) 与单次请求最多尝试次数
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_REQUEST_ATTEMPTS = 4
+MAX_RETRY_DELAY = 30
+
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """请求重试等待时间: 优先使用 Retry-After (秒), 否则 0.5 * 2^attempt 加抖动"""
+    if retry_after:
+        try:
+            return min(MAX_RETRY_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            pass  # HTTP-date 格式, 使用指数退避
+    return min(MAX_RETRY_DELAY, 0.5 * 2 ** attempt + poll_jitter())
+
+def json_dumps(obj: Any) -> str:
+    """aiohttp 的 json_serialize 需要返回 str, orjson.dumps 返回 bytes"""
+    return orjson.dumps(obj).decode()
+
+def install_event_loop_policy():
+    """
+    在 asyncio.run 之前调用, 选择最合适的事件循环
+    Windows 使用 Selector 循环 (aiohttp 兼容), POSIX 上优先使用 uvloop
+    """
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        return
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())  # uvloop.install() 在 3.12+ 已弃用
+
+def _response_field(obj: Any, key: str) -> Any:
+    """从 dict 或 msgspec.Struct 响应中取字段"""
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+# --- 共享连接池 ---
+
+# 所有 provider/SMSManager 共用一个连接池, DNS 缓存与 keep-alive 连接在进程内共享
+# 连接池绑定创建它的事件循环: 同一时间只支持一个事件循环, 循环结束前需调用 close_shared_connector()
+_SHARED_CONNECTOR: Optional[aiohttp.TCPConnector] = None
+_SHARED_CONNECTOR_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+def _get_shared_connector() -> aiohttp.TCPConnector:
+    """懒加载共享连接池, 需在事件循环内调用"""
+    global _SHARED_CONNECTOR, _SHARED_CONNECTOR_LOOP
+    loop = asyncio.get_running_loop()
+    if _SHARED_CONNECTOR is not None and not _SHARED_CONNECTOR.closed:
+        if _SHARED_CONNECTOR_LOOP is not loop:
+            raise RuntimeError("Shared connector belongs to another event loop; call close_shared_connector() before switching loops")
+        return _SHARED_CONNECTOR
+    _SHARED_CONNECTOR = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=10,
+        keepalive_timeout=75,
+        ttl_dns_cache=600,
+        enable_cleanup_closed=True
+    )
+    _SHARED_CONNECTOR_LOOP = loop
+    return _SHARED_CONNECTOR
+
+async def close_shared_connector():
+    """关闭共享连接池, 在程序退出前调用"""
+    global _SHARED_CONNECTOR, _SHARED_CONNECTOR_LOOP
+    if _SHARED_CONNECTOR is not None and not _SHARED_CONNECTOR.closed:
+        await _SHARED_CONNECTOR.close()
+    _SHARED_CONNECTOR = None
+    _SHARED_CONNECTOR_LOOP = None
+
 # --- 抽象基类 ---
 
 class BaseSMSProvider(ABC):
+    _check_spec: ClassVar[CheckSpec]
+
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.base_url = ""
+        self.headers: Optional[Dict[str, str]] = None  # 会话级默认请求头
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 轮询缓存: 按 cache_key (订单号) 记录上次响应的 ETag / 正文摘要
+        self._etags: Dict[str, str] = {}
+        self._body_digests: Dict[str, bytes] = {}
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """懒加载长连接会话, 复用共享连接池避免每次轮询重新握手"""
+        connector = _get_shared_connector()
+        if self._session is None or self._session.closed or self._session.connector is not connector:
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                connector_owner=False,
+                headers=self.headers,
+                json_serialize=json_dumps
+            )
+        return self._session
+
+    async def close(self):
+        """关闭会话 (共享连接池由 close_shared_connector 统一关闭)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     @abstractmethod
     async def get_balance(self) -> float:
@@ -97,59 +250,245 @@ class BaseSMSProvider(ABC):
         """取消租用"""
         pass
 
-    async def _make_request(self, method: str, url: str, params: dict = None, headers: dict = None, json_data: dict = None) -> Dict:
-        """统一的异步请求处理"""
-        async with aiohttp.ClientSession() as session:
+    @staticmethod
+    def _extract_code(text: Optional[str]) -> Optional[str]:
+        """
+        从短信正文中提取验证码
+        快速路径: 找到第一段连续数字, 若长度为 4-8 且前后不是单词字符则直接返回;
+        其余情况 (如夹在字母中间, 或超长数字串) 才交给 _CODE_RE 处理
+        """
+        if not text:
+            return None
+        n = len(text)
+        start = 0
+        while start < n and not text[start].isdecimal():
+            start += 1
+        if start == n:
+            return None
+        end = start
+        while end < n and text[end].isdecimal():
+            end += 1
+        bounded = (start == 0 or not (text[start - 1].isalnum() or text[start - 1] == '_')) and \
+                  (end == n or not (text[end].isalnum() or text[end] == '_'))
+        if 4 <= end - start <= 8 and bounded:
+            return text[start:end]
+        match = _CODE_RE.search(text, end)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def _should_retry(status: int, attempt: int, retry_server_errors: bool) -> bool:
+        """
+        429 表示请求被限流拒绝, 总是重试;
+        5xx 网关错误时请求可能已被服务端处理, 只有调用方声明为只读请求时才重试
+        (SMS-Man/Vak-SMS 的租号接口也是 GET, 重试会重复扣费)
+        """
+        if attempt >= MAX_REQUEST_ATTEMPTS - 1:
+            return False
+        if status == 429:
+            return True
+        return retry_server_errors and status in RETRY_STATUSES
+
+    def _apply_check(self, resp: Any, order: SMSOrder) -> SMSOrder:
+        """按 _check_spec 将 check_sms 响应写回订单"""
+        spec = self._check_spec
+        if spec.list_key is not None:
+            entries = _response_field(resp, spec.list_key) or []
+        elif isinstance(resp, list):
+            entries = resp
+        else:
+            entries = [resp]
+
+        if entries:
+            last_sms = entries[-1]  # 获取最新一条
+            text = _response_field(last_sms, spec.text_key)
+            code = _response_field(last_sms, spec.code_key)
+            if text or code:
+                order.sms_text = str(text) if text else None
+                code = str(code) if code else None
+                # 部分平台的 code 字段实际是完整短信, 统一提取数字验证码
+                order.sms_code = (self._extract_code(code) or code) if code else self._extract_code(order.sms_text)
+                order.status = RentStatus.RECEIVED
+
+        if spec.finished_value is not None:
+            key, value = spec.finished_value
+            if _response_field(resp, key) == value:
+                order.status = RentStatus.FINISHED
+
+        return order
+
+    def forget_cached_response(self, cache_key: str):
+        """清除订单的轮询缓存 (ETag/正文摘要), 订单结束后调用"""
+        self._etags.pop(cache_key, None)
+        self._body_digests.pop(cache_key, None)
+
+    async def _make_request(self, method: str, url: str, params: dict = None, headers: dict = None, json_data: dict = None, cache_key: Optional[str] = None, response_type: Optional[type] = None, retry_server_errors: bool = False) -> Any:
+        """
+        统一的异步请求处理
+        :param cache_key: 轮询类请求的缓存键 (如订单号)。指定后发送 If-None-Match,
+                          响应为 304 或正文与上次相同时返回 None, 调用方可直接跳过解析
+        :param response_type: msgspec.Struct 类型, 指定后直接将响应解码为该类型而不是 dict
+        :param retry_server_errors: 是否在 502/503/504 时重试, 仅限余额/查询等只读请求, 租号/取消不可设置
+        """
+        if cache_key is not None and cache_key in self._etags:
+            headers = {**(headers or {}), "If-None-Match": self._etags[cache_key]}
+
+        session = await self._get_session()
+        delay = 0.0
+        for attempt in range(MAX_REQUEST_ATTEMPTS):
+            if delay:
+                await asyncio.sleep(delay)
             try:
                 async with session.request(method, url, params=params, headers=headers, json=json_data) as response:
                     content_type = response.headers.get('Content-Type', '')
-                    
+                
+                    if response.status == 304:
+                        return None
+
+                    if self._should_retry(response.status, attempt, retry_server_errors):
+                        delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                        logger.warning(f"API returned {response.status} for {url}, retry {attempt + 1}/{MAX_REQUEST_ATTEMPTS - 1} in {delay:.1f}s")
+                        continue
+
                     if response.status >= 400:
                         text = await response.text()
                         logger.error(f"API Error [{response.status}] {url}: {text}")
                         raise APIRequestError(f"API returned {response.status}: {text}")
 
-                    if 'application/json' in content_type:
-                        return await response.json()
+                    # 直接读取 bytes 交给 orjson 解析, 省去 str 解码与 stdlib json
+                    data = await response.read()
+                    if not data.strip():
+                        return None  # 空响应 (如 set-status/finish), 与 aiohttp 的 response.json() 行为一致
+                    etag = digest = None
+                    if cache_key is not None:
+                        etag = response.headers.get("ETag")
+                        if not etag:
+                            # 不支持 ETag 的平台: 正文摘要未变化即视为无更新
+                            digest = hashlib.blake2b(data, digest_size=8).digest()
+                            if self._body_digests.get(cache_key) == digest:
+                                return None
+
+                    if response_type is not None:
+                        try:
+                            result = msgspec.json.decode(data, type=response_type)
+                        except msgspec.DecodeError as e:
+                            raise APIRequestError(f"Unexpected response from {url}: {e}")
                     else:
-                        # 处理某些API返回纯文本的情况
-                        text = await response.text()
                         try:
-                            return json.loads(text)
-                        except json.JSONDecodeError:
-                            return {"text_response": text}
+                            result = orjson.loads(data)
+                        except orjson.JSONDecodeError:
+                            if 'application/json' in content_type:
+                                raise APIRequestError(f"Malformed JSON from {url}")
+                            # 处理某些API返回纯文本的情况
+                            result = {"text_response": await response.text()}
+
+                    # 解析成功后才记录 ETag/摘要, 否则错误响应会在后续轮询中被当作"无变化"而被掩盖
+                    if etag:
+                        self._etags[cache_key] = etag
+                    elif digest is not None:
+                        self._body_digests[cache_key] = digest
+                    return result
             except aiohttp.ClientError as e:
                 logger.error(f"Network error requesting {url}: {str(e)}")
                 raise APIRequestError(f"Network error: {str(e)}")
+            except asyncio.TimeoutError:
+                # aiohttp 的总超时不属于 ClientError, 统一转换以免中断 wait_for_codes 的整批轮询
+                logger.error(f"Timeout requesting {url}")
+                raise APIRequestError(f"Request timed out: {url}")
 
 # --- 具体实现: SMS-Man ---
 
 class SMSManProvider(BaseSMSProvider):
+    # 假设响应是一个列表, 每条包含 text/code
+    # SMS-Man Rent API 返回结构可能较复杂，需根据实际文档调整
+    _check_spec = CheckSpec(list_key=None, code_key="code", text_key="text")
+
+    # 国家/服务 -> 数字 ID 映射表, 进程内所有实例共享
+    MAPPING_CACHE_TTL = 60 * 60  # 1 hour
+    _country_cache: Dict[str, int] = {}
+    _service_cache: Dict[str, int] = {}
+    _cache_ts: Optional[float] = None  # None 表示尚未加载
+
     def __init__(self, api_key: str):
         super().__init__(api_key)
         self.base_url = "https://api.sms-man.com/rent-api"
+        self._auth_params = {"token": api_key}  # 只读, 每次请求在此基础上合并
+
+    @classmethod
+    def _mappings_expired(cls) -> bool:
+        # monotonic() 从开机起计时, 不能用 0 作为"从未加载"的哨兵值
+        if cls._cache_ts is None:
+            return True
+        return time.monotonic() - cls._cache_ts > cls.MAPPING_CACHE_TTL
+
+    @classmethod
+    def _store_mappings(cls, countries: Dict[str, int], services: Dict[str, int]):
+        SMSManProvider._country_cache = countries
+        SMSManProvider._service_cache = services
+        SMSManProvider._cache_ts = time.monotonic()
+
+    @staticmethod
+    def _parse_mapping(resp: Any) -> Dict[str, int]:
+        """
+        将 /get-countries, /get-services 的响应转换为 {code/名称(小写): id}
+        响应可能是 {"1": {"id": 1, "code": "ru", ...}} 或 [{"id": 1, "code": "ru"}, ...]
+        """
+        items = resp.values() if isinstance(resp, dict) else resp
+        mapping: Dict[str, int] = {}
+        for item in items:
+            if not isinstance(item, dict) or "id" not in item:
+                continue
+            for key in ("code", "title", "name"):
+                value = item.get(key)
+                if value:
+                    mapping[str(value).lower()] = int(item["id"])
+        return mapping
+
+    async def _refresh_mappings(self):
+        countries = await self._make_request("GET", f"{self.base_url}/get-countries", params=self._auth_params, retry_server_errors=True)
+        services = await self._make_request("GET", f"{self.base_url}/get-services", params=self._auth_params, retry_server_errors=True)
+        # 出错或映射为空时不写入缓存, 避免一次失败导致之后一小时内的查询全部失败
+        for resp in (countries, services):
+            if isinstance(resp, dict) and "error_code" in resp:
+                raise APIRequestError(f"SMS-Man Error: {resp.get('error_msg')}")
+        country_map = self._parse_mapping(countries)
+        service_map = self._parse_mapping(services)
+        if not country_map or not service_map:
+            raise APIRequestError("SMS-Man: empty country/service mapping")
+        self._store_mappings(country_map, service_map)
+
+    async def _lookup_id(self, cache_name: str, value: str) -> int:
+        # 已经是数字 ID 时直接使用, 无需请求映射表
+        if str(value).isdigit():
+            return int(value)
+        if self._mappings_expired():
+            await self._refresh_mappings()
+        key = str(value).lower()
+        mapping = getattr(SMSManProvider, cache_name)
+        if key not in mapping:
+            raise SMSException(f"SMS-Man: unknown {cache_name.split('_')[1]} '{value}'")
+        return mapping[key]
+
+    async def _get_country_id(self, country: str) -> int:
+        return await self._lookup_id("_country_cache", country)
+
+    async def _get_service_id(self, service: str) -> int:
+        return await self._lookup_id("_service_cache", service)
 
     async def get_balance(self) -> float:
         # SMS-Man Rent API 的余额通常和主站通用，但文档主要列出了 rent 的操作
         # 这里使用主 API 获取余额
         url = "http://api.sms-man.com/control/get-balance"
-        data = await self._make_request("GET", url, params={"token": self.api_key})
+        data = await self._make_request("GET", url, params=self._auth_params, retry_server_errors=True)
         # 格式通常是 {"balance": "100.50"}
         return float(data.get("balance", 0.0))
 
     async def rent_number(self, country: str, service: str, duration: int = 4) -> SMSOrder:
-        # 注意：SMS-Man 需要将国家和服务的 string 转换为内部 ID。
-        # 为简化，这里假设调用者知道 ID，或者实际项目中需要做一个 Mapping 字典。
-        # 此处演示直接调用，需要自行维护 country_id 和 service_id 的映射。
-        # 假设 country='us' -> id 3 (示例), service='tg' -> id 1 (示例)
-        # 实际开发中建议先调用 /get-countries 和 /get-services 获取映射
-        
+        # SMS-Man 需要数字形式的 country_id / service_id
+        # 传入 iso2/服务代码时通过缓存的 /get-countries, /get-services 映射表转换 (TTL 1 小时)
         url = f"{self.base_url}/get-number"
-        # 警告：SMS-Man API 参数非常依赖 ID，这里仅作逻辑演示，实际需传入数字 ID
-        params = {
-            "token": self.api_key,
-            "country_id": country,  # 用户需传入 ID
-            "service_id": service,  # 用户需传入 ID
+        params = self._auth_params | {
+            "country_id": await self._get_country_id(country),
+            "service_id": await self._get_service_id(service),
             "time": duration * 60   # 假设单位是分钟
         }
         
@@ -170,31 +509,36 @@ class SMSManProvider(BaseSMSProvider):
 
     async def check_sms(self, order: SMSOrder) -> SMSOrder:
         url = f"{self.base_url}/get-sms"
-        params = {"token": self.api_key, "request_id": order.order_id}
+        params = self._auth_params | {"request_id": order.order_id}
         
-        resp = await self._make_request("GET", url, params=params)
+        resp = await self._make_request("GET", url, params=params, cache_key=order.order_id, retry_server_errors=True)
+        if resp is None:
+            return order  # 与上次轮询相比无变化
         
-        # 假设响应是一个列表或包含 sms 字段
-        # SMS-Man Rent API 返回结构可能较复杂，需根据实际文档调整
-        # 这里模拟收到短信
-        if isinstance(resp, list) and len(resp) > 0:
-            last_sms = resp[-1] # 获取最新一条
-            order.sms_text = last_sms.get("text")
-            order.sms_code = last_sms.get("code")
-            order.status = RentStatus.RECEIVED
-        
-        return order
+        return self._apply_check(resp, order)
 
     async def cancel_rent(self, order_id: str) -> bool:
         url = f"{self.base_url}/set-status"
         # status 2 usually means close/cancel in many APIs, check documentation
-        params = {"token": self.api_key, "request_id": order_id, "status": 2}
+        params = self._auth_params | {"request_id": order_id, "status": 2}
         await self._make_request("GET", url, params=params)
+        self.forget_cached_response(order_id)
         return True
 
 # --- 具体实现: 5SIM ---
 
+class FiveSimSms(msgspec.Struct):
+    text: Optional[str] = None
+    code: Optional[str] = None
+
+class FiveSimCheckResp(msgspec.Struct):
+    """/user/check/{id} 响应中用到的字段, 其余字段解码时忽略"""
+    status: str = ""
+    sms: Optional[List[FiveSimSms]] = None  # 尚未收到短信时 5SIM 返回 null
+
 class FiveSimProvider(BaseSMSProvider):
+    _check_spec = CheckSpec(list_key="sms", code_key="code", text_key="text", finished_value=("status", "FINISHED"))
+
     def __init__(self, api_key: str):
         super().__init__(api_key)
         self.base_url = "https://5sim.net/v1"
@@ -205,7 +549,7 @@ class FiveSimProvider(BaseSMSProvider):
 
     async def get_balance(self) -> float:
         url = f"{self.base_url}/user/profile"
-        data = await self._make_request("GET", url, headers=self.headers)
+        data = await self._make_request("GET", url, retry_server_errors=True)
         return float(data.get("balance", 0.0))
 
     async def rent_number(self, country: str, service: str, duration: int = None) -> SMSOrder:
@@ -214,7 +558,7 @@ class FiveSimProvider(BaseSMSProvider):
         url = f"{self.base_url}/user/buy/hosting/{country}/{service}"
         
         logger.info(f"Requesting 5SIM Hosting: {url}")
-        resp = await self._make_request("POST", url, headers=self.headers)
+        resp = await self._make_request("POST", url)
         
         # 5SIM 响应包含 id, phone 等
         if "id" not in resp:
@@ -226,48 +570,45 @@ class FiveSimProvider(BaseSMSProvider):
             country=country,
             service=service,
             provider=ProviderType.FIVE_SIM,
-            expiration_time=resp.get("expires") # 5SIM 返回 ISO 时间
+            expiration_time=parse_iso_datetime(resp.get("expires")) # 5SIM 返回 ISO 时间
         )
 
     async def check_sms(self, order: SMSOrder) -> SMSOrder:
         # 5SIM 检查订单详情
         url = f"{self.base_url}/user/check/{order.order_id}"
-        resp = await self._make_request("GET", url, headers=self.headers)
-        
-        sms_list = resp.get("sms", [])
-        if sms_list:
-            last_sms = sms_list[-1]
-            order.sms_text = last_sms.get("text")
-            order.sms_code = last_sms.get("code")
-            order.status = RentStatus.RECEIVED
-        
-        if resp.get("status") == "FINISHED":
-            order.status = RentStatus.FINISHED
+        resp = await self._make_request("GET", url, cache_key=order.order_id, response_type=FiveSimCheckResp, retry_server_errors=True)
+        if resp is None:
+            return order  # 与上次轮询相比无变化
         
-        return order
+        return self._apply_check(resp, order)
 
     async def cancel_rent(self, order_id: str) -> bool:
         # 5SIM Hosting 通常不能立刻取消退款，或者是 finish
         url = f"{self.base_url}/user/finish/{order_id}"
-        await self._make_request("GET", url, headers=self.headers)
+        await self._make_request("GET", url)
+        self.forget_cached_response(order_id)
         return True
 
 # --- 具体实现: Vak-SMS ---
 
 class VakSMSProvider(BaseSMSProvider):
+    # Vak-SMS returns {"smsCode": "..."} or {"error": "wait"}
+    # Vak 有时候只给 code，有时候有 full text, _apply_check 会从中提取数字验证码
+    _check_spec = CheckSpec(list_key=None, code_key="smsCode", text_key="smsCode")
+
     def __init__(self, api_key: str):
         super().__init__(api_key)
         self.base_url = "https://vak-sms.com/api"
+        self._auth_params = {"apiKey": api_key}  # 只读, 每次请求在此基础上合并
 
     async def get_balance(self) -> float:
         url = f"{self.base_url}/getBalance/"
-        resp = await self._make_request("GET", url, params={"apiKey": self.api_key})
+        resp = await self._make_request("GET", url, params=self._auth_params, retry_server_errors=True)
         return float(resp.get("balance", 0.0))
 
     async def rent_number(self, country: str, service: str, duration: int = 4) -> SMSOrder:
         url = f"{self.base_url}/getNumber/"
-        params = {
-            "apiKey": self.api_key,
+        params = self._auth_params | {
             "service": service,
             "country": country,
             "rent": "true" # 关键参数
@@ -294,24 +635,20 @@ class VakSMSProvider(BaseSMSProvider):
 
     async def check_sms(self, order: SMSOrder) -> SMSOrder:
         url = f"{self.base_url}/getSmsCode/"
-        params = {"apiKey": self.api_key, "idNum": order.order_id}
-        
-        resp = await self._make_request("GET", url, params=params)
+        params = self._auth_params | {"idNum": order.order_id}
         
-        # Vak-SMS returns {"smsCode": "..."} or {"error": "wait"}
-        if "smsCode" in resp and resp["smsCode"]:
-            order.sms_code = resp["smsCode"]
-            order.status = RentStatus.RECEIVED
-            # 尝试提取完整文本，Vak 有时候只给 code，有时候有 full text
-            order.sms_text = resp.get("smsCode") 
+        resp = await self._make_request("GET", url, params=params, cache_key=order.order_id, retry_server_errors=True)
+        if resp is None:
+            return order  # 与上次轮询相比无变化
         
-        return order
+        return self._apply_check(resp, order)
 
     async def cancel_rent(self, order_id: str) -> bool:
         url = f"{self.base_url}/setStatus/"
         # status: end (finish), bad (cancel/refund if no code)
-        params = {"apiKey": self.api_key, "idNum": order_id, "status": "end"}
+        params = self._auth_params | {"idNum": order_id, "status": "end"}
         await self._make_request("GET", url, params=params)
+        self.forget_cached_response(order_id)
         return True
 
 # --- 工厂管理类 ---
@@ -320,9 +657,16 @@ class SMSManager:
     """
     SMS服务统一管理器
     使用示例:
-    manager = SMSManager(provider_type=ProviderType.FIVE_SIM, api_key="abc...")
-    order = await manager.rent_number("russia", "google")
+    async with SMSManager(provider_type=ProviderType.FIVE_SIM, api_key="abc...") as manager:
+        order = await manager.rent_number("russia", "google")
     """
+
+    # Provider 注册表, 新增平台时在此登记
+    _PROVIDERS: ClassVar[Dict[ProviderType, Type[BaseSMSProvider]]] = {
+        ProviderType.SMS_MAN: SMSManProvider,
+        ProviderType.FIVE_SIM: FiveSimProvider,
+        ProviderType.VAK_SMS: VakSMSProvider,
+    }
     
     def __init__(self, provider_type: ProviderType, api_key: str):
         self.provider_type = provider_type
@@ -331,14 +675,21 @@ class SMSManager:
         logger.info(f"SMSManager initialized with {provider_type.value}")
 
     def _get_provider(self) -> BaseSMSProvider:
-        if self.provider_type == ProviderType.SMS_MAN:
-            return SMSManProvider(self.api_key)
-        elif self.provider_type == ProviderType.FIVE_SIM:
-            return FiveSimProvider(self.api_key)
-        elif self.provider_type == ProviderType.VAK_SMS:
-            return VakSMSProvider(self.api_key)
-        else:
+        try:
+            provider_cls = self._PROVIDERS[self.provider_type]
+        except KeyError:
             raise ValueError("Unsupported provider type")
+        return provider_cls(self.api_key)
+
+    async def __aenter__(self) -> "SMSManager":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """释放 provider 持有的网络会话"""
+        await self.provider.close()
 
     async def get_balance(self) -> float:
         return await self.provider.get_balance()
@@ -347,30 +698,119 @@ class SMSManager:
         """租用号码"""
         return await self.provider.rent_number(country, service, duration)
 
-    async def wait_for_code(self, order: SMSOrder, timeout_seconds: int = 300, check_interval: int = 5) -> SMSOrder:
+    async def rent_with_balance_check(self, country: str, service: str, duration: int = 4) -> Tuple[float, SMSOrder]:
+        """
+        并发查询余额与租用号码, 两个请求在一个 RTT 内完成
+        余额查询失败时等待租用请求结束 (请求可能已到达服务端并扣费, 不能只在客户端取消),
+        若号码已经租到则立即释放, 然后抛出原异常
+        :return: (余额, 订单对象)
+        """
+        balance_task = asyncio.create_task(self.get_balance())
+        rent_task = asyncio.create_task(self.rent_number(country, service, duration))
+        try:
+            balance = await balance_task
+        except BaseException:
+            try:
+                order = await rent_task
+            except Exception:
+                order = None  # 租用本身也失败了, 无需释放
+            if order is not None:
+                try:
+                    await self.cancel_rent(order.order_id)
+                except SMSException as e:
+                    logger.error(f"Failed to release order {order.order_id} after balance error: {e}")
+            raise
+        return balance, await rent_task
+
+    async def check_sms(self, order: SMSOrder) -> SMSOrder:
+        """检查一次短信状态"""
+        return await self.provider.check_sms(order)
+
+    async def cancel_rent(self, order_id: str) -> bool:
+        """取消/结束租用"""
+        return await self.provider.cancel_rent(order_id)
+
+    async def wait_for_code(self, order: SMSOrder, timeout_seconds: int = 300, check_interval: float = 3, max_interval: float = 15) -> SMSOrder:
         """
-        轮询等待验证码
+        轮询等待验证码 (指数退避 + 抖动)
         :param order: 订单对象
         :param timeout_seconds: 最大等待时间
-        :param check_interval: 检查间隔
+        :param check_interval: 初始检查间隔
+        :param max_interval: 检查间隔上限
         :return: 更新后的订单对象 (包含 code)
         """
-        start_time = datetime.now()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_seconds  # 单调时钟, 不受系统时间调整影响
+        interval = check_interval
         logger.info(f"Waiting for SMS code for order {order.order_id} ({order.phone_number})...")
         
-        while (datetime.now() - start_time).total_seconds() < timeout_seconds:
-            order = await self.provider.check_sms(order)
+        while loop.time() < deadline:
+            try:
+                order = await self.provider.check_sms(order)
+            except SMSException as e:
+                # 单次查询失败 (网络抖动/解析错误) 不终止轮询, 下一轮重试
+                logger.error(f"Error checking SMS for order {order.order_id}: {e}")
             
-            if order.status == RentStatus.RECEIVED or order.sms_code:
+            if order.is_complete:
                 logger.info(f"SMS Received: {order.sms_code}")
+                self.provider.forget_cached_response(order.order_id)
                 return order
             
-            await asyncio.sleep(check_interval)
+            await asyncio.sleep(interval + poll_jitter())
+            interval = next_poll_interval(interval, max_interval)
             
         logger.warning(f"Timeout waiting for SMS for order {order.order_id}")
         order.status = RentStatus.TIMEOUT
+        self.provider.forget_cached_response(order.order_id)
         return order
 
+    async def _check_bounded(self, order: SMSOrder, sem: asyncio.Semaphore) -> SMSOrder:
+        """在信号量限制下检查单个订单, 单个订单出错不影响其它订单"""
+        async with sem:
+            try:
+                return await self.provider.check_sms(order)
+            except SMSException as e:
+                logger.error(f"Error checking SMS for order {order.order_id}: {e}")
+                return order
+
+    async def wait_for_codes(self, orders: List[SMSOrder], timeout_seconds: int = 300, check_interval: float = 3, max_interval: float = 15, max_concurrency: int = 10) -> List[SMSOrder]:
+        """
+        并发轮询多个订单的验证码, 每一轮用 asyncio.gather 同时检查所有等待中的订单
+        :param orders: 订单列表
+        :param timeout_seconds: 最大等待时间
+        :param check_interval: 初始检查间隔
+        :param max_interval: 检查间隔上限
+        :param max_concurrency: 同时进行的请求数上限
+        :return: 更新后的订单列表 (顺序与传入一致)
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_seconds  # 单调时钟, 不受系统时间调整影响
+        interval = check_interval
+        sem = asyncio.Semaphore(max_concurrency)
+        orders = list(orders)
+        logger.info(f"Waiting for SMS codes for {len(orders)} orders...")
+
+        pending = [i for i, o in enumerate(orders) if o.status is RentStatus.WAITING and not o.is_complete]
+        while pending and loop.time() < deadline:
+            results = await asyncio.gather(*[self._check_bounded(orders[i], sem) for i in pending])
+            for i, order in zip(pending, results):
+                orders[i] = order
+                if order.is_complete:
+                    logger.info(f"SMS Received for order {order.order_id}: {order.sms_code}")
+
+            pending = [i for i in pending if orders[i].status is RentStatus.WAITING and not orders[i].is_complete]
+            if not pending:
+                break
+            await asyncio.sleep(interval + poll_jitter())
+            interval = next_poll_interval(interval, max_interval)
+
+        for order in orders:
+            if order.status is RentStatus.WAITING and not order.is_complete:
+                logger.warning(f"Timeout waiting for SMS for order {order.order_id}")
+                order.status = RentStatus.TIMEOUT
+            self.provider.forget_cached_response(order.order_id)
+        return orders
+
 # --- 测试代码 ---
 if __name__ == "__main__":
     # 简单的运行测试
@@ -380,4 +820,5 @@ if __name__ == "__main__":
         # manager = SMSManager(ProviderType.VAK_SMS, "your_key")
         # print(await manager.get_balance())
     
+    install_event_loop_policy()
     asyncio.run(main())
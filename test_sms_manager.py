@@ -1,7 +1,6 @@
 import asyncio
 import argparse
-import sys
-from sms_manager import SMSManager, ProviderType, SMSException, RentStatus
+from sms_manager import SMSManager, ProviderType, SMSException, install_event_loop_policy, close_shared_connector
 
 async def main():
     parser = argparse.ArgumentParser(description="Test SMS Manager Module")
@@ -26,13 +25,15 @@ async def main():
     try:
         print(f"[*] Initializing {args.provider}...")
         
-        # 1. Check Balance
-        balance = await manager.get_balance()
-        print(f"[*] Current Balance: {balance}")
+        if args.action == "balance":
+            balance = await manager.get_balance()
+            print(f"[*] Current Balance: {balance}")
         
         if args.action == "rent":
+            # Balance check and rent are issued concurrently (one round trip)
             print(f"[*] Attempting to rent number for {args.service} in {args.country}...")
-            order = await manager.rent_number(args.country, args.service)
+            balance, order = await manager.rent_with_balance_check(args.country, args.service)
+            print(f"[*] Current Balance: {balance}")
             print(f"[+] Rent Successful!")
             print(f"    Order ID: {order.order_id}")
             print(f"    Phone: {order.phone_number}")
@@ -43,7 +44,7 @@ async def main():
                 # Wait for 2 minutes for testing
                 order = await manager.wait_for_code(order, timeout_seconds=120)
                 
-                if order.status == RentStatus.RECEIVED:
+                if order.is_complete:
                     print(f"\n[SUCCESS] SMS Code Received: {order.sms_code}")
                     print(f"Full Message: {order.sms_text}")
                 else:
@@ -59,8 +60,10 @@ async def main():
         print(f"[ERROR] SMS API Error: {str(e)}")
     except Exception as e:
         print(f"[ERROR] Unexpected Error: {str(e)}")
+    finally:
+        await manager.close()
+        await close_shared_connector()
 
 if __name__ == "__main__":
-    if sys.platform == 'win32':
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    install_event_loop_policy()
     asyncio.run(main())